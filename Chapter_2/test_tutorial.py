@@ -12,10 +12,16 @@ import sys
 
 from queue import Queue
 from queue import Empty
+from queue import Full
 
 import random
+import threading
 import time
 
+from collections import Counter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 
 try:
     import numpy as np
@@ -50,20 +56,167 @@ from agents.navigation.behavior_agent import BehaviorAgent  # pylint: disable=im
 from agents.navigation.basic_agent import BasicAgent  # pylint: disable=import-error
 
 
+# number of random vehicles added besides the ego vehicle
+NUMBER_OF_VEHICLES = 10
+
+# where the sensor data is saved, the paths are formatted with the frame id
+OUT_DIR = '_out'
+IMAGE_PATH_FORMAT = os.path.join(OUT_DIR, '%06d.npy')
+LIDAR_PATH_FORMAT = os.path.join(OUT_DIR, '%06d.ply')
+
+# camera image size
+IMAGE_WIDTH = 640
+IMAGE_HEIGHT = 480
+
+# number of shared memory slots the camera frames are published to, so that
+# consumers on the same host can read them without going through the disk.
+# 0 saves the frames to _out instead
+SHARED_MEMORY_SLOTS = 0
+
 
-def sensor_callback(sensor_data, sensor_queue, sensor_name):
-    if 'lidar' in sensor_name:
-        sensor_data.save_to_disk('_out/%06d.png' % sensor_data.frame)
-    if 'camera' in sensor_name:
-        sensor_data.save_to_disk('_out/%06d.png' % sensor_data.frame)
+def create_frame_ring(slots, height, width):
+    # one shared memory block per slot, named 'carla_camera_<pid>_<slot>': an int64
+    # frame id followed by the BGRA image. The frame id is -1 while the slot is
+    # written. A slot is rewritten len(frame_ring) frames later, so consumers must
+    # read the frame id before and after copying the image and drop the copy if
+    # the two differ (or either is -1)
+    if not slots:
+        return []
+    # imported here since it needs Python 3.8, while the CARLA eggs target 3.7
+    from multiprocessing import shared_memory
+
+    frame_ring = []
+    try:
+        for slot in range(slots):
+            shm = shared_memory.SharedMemory(name='carla_camera_%d_%d' % (os.getpid(), slot),
+                                             create=True, size=8 + height * width * 4)
+            frame_ring.append(shm)
+            np.ndarray((1,), dtype=np.int64, buffer=shm.buf)[0] = -1
+    except BaseException:
+        for shm in frame_ring:
+            shm.close()
+            shm.unlink()
+        raise
+    return frame_ring
+
+
+def publish_frame(frame_ring, sensor_data):
+    shm = frame_ring[sensor_data.frame % len(frame_ring)]
+    header = np.ndarray((1,), dtype=np.int64, buffer=shm.buf)
+    image = np.ndarray((sensor_data.height, sensor_data.width, 4), dtype=np.uint8,
+                       buffer=shm.buf, offset=8)
+    header[0] = -1
+    image[:] = np.frombuffer(sensor_data.raw_data, dtype=np.uint8).reshape(image.shape)
+    header[0] = sensor_data.frame
+
+
+def pick_spawn_points(spawn_points, count, min_distance=2.5):
+    # pick random spawn points at least min_distance meters apart, spawning
+    # vehicles on top of each other fails with a collision
+    picked = []
+    for point in random.sample(spawn_points, len(spawn_points)):
+        if all(point.location.distance(p.location) >= min_distance for p in picked):
+            picked.append(point)
+            if len(picked) == count:
+                return picked
+    raise RuntimeError('only %d of the %d spawn points needed are %.1f m apart'
+                       % (len(picked), count, min_distance))
+
+
+def drop_page_cache(path):
+    # the saved files are never read back, so evict them from the page cache to
+    # keep it for the simulator (posix_fadvise is not on Windows). Dirty pages are
+    # not dropped, the call only starts their writeback
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def writer_loop(writer_queue):
+    # save the sensor data to disk outside of the sensor thread, None stops the loop.
+    # The raw BGR image is dumped as .npy, which is much cheaper than a PNG encode.
+    # raw_data is viewed without copying and the alpha channel is dropped into a
+    # preallocated buffer, so no image sized array is allocated per frame
+    scratch = np.empty((IMAGE_HEIGHT, IMAGE_WIDTH, 3), dtype=np.uint8)
+    # files are evicted from the page cache right after the write, and once more
+    # 20 files later when their writeback is done, so the writer never blocks on it
+    written = deque()
+    while True:
+        item = writer_queue.get()
+        if item is None:
+            break
+        frame, sensor_data = item
+        # a failed write only loses that frame, the thread must keep running
+        try:
+            if not isinstance(sensor_data, carla.Image):
+                path = LIDAR_PATH_FORMAT % frame
+                sensor_data.save_to_disk(path)
+            else:
+                image = np.frombuffer(sensor_data.raw_data, dtype=np.uint8)
+                image = image.reshape((sensor_data.height, sensor_data.width, 4))
+                if scratch.shape != (sensor_data.height, sensor_data.width, 3):
+                    scratch = np.empty((sensor_data.height, sensor_data.width, 3), dtype=np.uint8)
+                np.copyto(scratch, image[:, :, :3])
+                path = IMAGE_PATH_FORMAT % frame
+                with open(path, 'wb') as f:
+                    np.save(f, scratch)
+        except OSError as e:
+            print('failed to save frame %d: %s' % (frame, e))
+            continue
+        drop_page_cache(path)
+        written.append(path)
+        if len(written) > 20:
+            drop_page_cache(written.popleft())
+
+
+def sensor_callback(sensor_data, sensor_queue, sensor_name, writer_queue, frame_ring=None):
+    if frame_ring and 'camera' in sensor_name:
+        publish_frame(frame_ring, sensor_data)
+    elif 'lidar' in sensor_name or 'camera' in sensor_name:
+        # hand the frame over to the writer thread, dropping the oldest one if it lags
+        try:
+            writer_queue.put_nowait((sensor_data.frame, sensor_data))
+        except Full:
+            try:
+                writer_queue.get_nowait()
+            except Empty:
+                pass
+            try:
+                writer_queue.put_nowait((sensor_data.frame, sensor_data))
+            except Full:
+                # the main thread took the slot (shutdown sentinel), drop the frame
+                pass
+    # drop the stale frame (if any) so the main loop always gets the freshest one
+    try:
+        sensor_queue.get_nowait()
+    except Empty:
+        pass
     sensor_queue.put((sensor_data.frame, sensor_name))
 
 
 def main():
 
     actor_list = []
+    vehicle_list = []
     picked_spawn_points_list = []
 
+    # images are written to disk by a dedicated thread
+    os.makedirs(OUT_DIR, exist_ok=True)
+    writer_queue = Queue(maxsize=4)
+    writer_thread = threading.Thread(target=writer_loop, args=(writer_queue,), daemon=True)
+    writer_thread.start()
+    camera = None
+
+    # or published to shared memory, a failed creation cleans up after itself
+    frame_ring = create_frame_ring(SHARED_MEMORY_SLOTS, IMAGE_HEIGHT, IMAGE_WIDTH)
+
     # In this tutorial script, we are going to add a vehicle to the simulation
     # and let it drive in autopilot. We will also create a camera attached to
     # that vehicle, and save all the images generated by the camera to disk.
@@ -84,6 +237,8 @@ def main():
         settings.synchronous_mode = True
         # 20fps
         settings.fixed_delta_seconds = 0.05
+        # the camera needs the rendering, settings.no_rendering_mode = True
+        # saves the GPU when no camera is attached
         world.apply_settings(settings)
 
 
@@ -98,6 +253,12 @@ def main():
         # Traffic manager and its sync mode
         tm = client.get_trafficmanager(8000)
         tm.set_synchronous_mode(True) 
+        # only simulate the physics of the vehicles within 70 m of the ego vehicle,
+        # full physics for all the cars delays the camera images on slower machines
+        tm.set_hybrid_physics_mode(True)
+        tm.set_hybrid_physics_radius(70.0)
+        # deterministic traffic manager behaviour
+        tm.set_random_device_seed(0)
 
         # The world contains the list blueprints that we can use for adding new
         # actors into the simulation.
@@ -112,15 +273,22 @@ def main():
         # let's randomize its color.
         if vehicle1_bp.has_attribute('color'):
             vehicle1_bp.set_attribute('color', '255,255,255')
+        # the traffic manager's hybrid physics is centered on the 'hero' vehicle
+        vehicle1_bp.set_attribute('role_name', 'hero')
 
-        # get avaliable spawn points 
-        spawn_points = world.get_map().get_spawn_points()
-        random.shuffle(spawn_points)
+        # get the map once, every get_map() call is a round trip to the server
+        carla_map = world.get_map()
+
+        # get avaliable spawn points and pick the ones we need at once: the ego
+        # vehicle, the other vehicles and the destination
+        spawn_points = pick_spawn_points(carla_map.get_spawn_points(), NUMBER_OF_VEHICLES + 2)
+        vehicle_spawn_points = spawn_points[1:-1]
+        destination_spawn_point = spawn_points[-1]
 
         # Now we need to give an initial transform to the vehicle. We choose a
         # random transform from the list of recommended spawn points of the map.
 
-        vehicle1_spawn_point = spawn_points[-1]
+        vehicle1_spawn_point = spawn_points[0]
         vehicle1 = world.spawn_actor(vehicle1_bp, vehicle1_spawn_point)
         picked_spawn_points_list.append(vehicle1_spawn_point)
 
@@ -139,27 +307,36 @@ def main():
 
         # Add another 10 random vehicles and store all the 10 vehicles in link list vehicle and
         # destroy them afterwards.
-        NUMBER_OF_VEHICLES = 10
-
-        vehicle_bps = world.get_blueprint_library().filter('vehicle.*.*')
+        # filter the 4-wheeled blueprints once, every get_attribute() call goes
+        # through the C++ binding
+        vehicle_bps = tuple(bp for bp in blueprint_library.filter('vehicle.*.*')
+                            if int(bp.get_attribute('number_of_wheels')) == 4)
 
-        vehicle_bps = [x for x in vehicle_bps if int(x.get_attribute('number_of_wheels')) == 4]
+        tm_port = tm.get_port()
 
-        vehicle_list = []
-
-        for i in range(NUMBER_OF_VEHICLES):
-            point = spawn_points[i]
-            vehicle_bp = np.random.choice(vehicle_bps)
-            try:
-                vehicle = world.spawn_actor(vehicle_bp, point)
-                picked_spawn_points_list.append(point)
-                vehicle_list.append(vehicle)
-                vehicle.set_autopilot(True,8000)
-                print('created %s' % vehicle.type_id)
-
-            except:
-                print('failed')
-                pass
+        # spawn all the vehicles and put them on autopilot in a single round trip
+        batch = []
+        for point in vehicle_spawn_points:
+            vehicle_bp = random.choice(vehicle_bps)
+            batch.append(carla.command.SpawnActor(vehicle_bp, point)
+                         .then(carla.command.SetAutopilot(carla.command.FutureActor, True, tm_port)))
+
+        vehicle_ids = []
+        failed = Counter()
+        for i, response in enumerate(client.apply_batch_sync(batch, True)):
+            if response.error:
+                failed[response.error] += 1
+            else:
+                picked_spawn_points_list.append(vehicle_spawn_points[i])
+                vehicle_ids.append(response.actor_id)
+        if failed:
+            print('failed to spawn %d of %d vehicles: %s' % (
+                sum(failed.values()), len(batch),
+                ', '.join('%s (x%d)' % (error, n) for error, n in failed.items())))
+
+        vehicle_list = list(world.get_actors(vehicle_ids))
+        for vehicle in vehicle_list:
+            print('created %s' % vehicle.type_id)
 
 
         # set several of the cars as dangerous car with traffic manager
@@ -167,10 +344,9 @@ def main():
         # set the difference the vehicle's intended speed and its current speed limit
         tm.global_percentage_speed_difference(30.0)
 
-        tm_port = tm.get_port()
+        # autopilot is already set by the spawn batch, the traffic manager has no
+        # batch commands for the remaining knobs so they are set in a single pass
         for v in vehicle_list:
-            v.set_autopilot(True, tm_port)
-
             # tell the vehicle to ignore traffic lights in 5% of cases
             tm.ignore_lights_percentage(v,5)
 
@@ -181,12 +357,16 @@ def main():
             tm.vehicle_percentage_speed_difference(v,-20)
 
 
-        # create sensor queue
-        sensor_queue = Queue(maxsize=10)
+        # create sensor queue, only the latest frame is kept
+        sensor_queue = Queue(maxsize=1)
 
         # Let's add now a camera attached to the vehicle. Note that the
         # transform we give here is now relative to the vehicle.
         camera_bp = blueprint_library.find('sensor.camera.rgb')
+        # keep the image small enough for the writer thread to save every frame,
+        # in sync mode the default sensor_tick gives one image per world tick
+        camera_bp.set_attribute('image_size_x', str(IMAGE_WIDTH))
+        camera_bp.set_attribute('image_size_y', str(IMAGE_HEIGHT))
         camera_transform = carla.Transform(carla.Location(x=-5, z=2))
         camera = world.spawn_actor(camera_bp, camera_transform, attach_to=vehicle1)
         actor_list.append(camera)
@@ -195,7 +375,7 @@ def main():
         # set the callback function
         # register the function that will be called each time the sensor
         # receives an image. In this example we are saving the image to disk
-        camera.listen(lambda image: sensor_callback(image, sensor_queue, "camera"))
+        camera.listen(lambda image: sensor_callback(image, sensor_queue, "camera", writer_queue, frame_ring))
 
 
         # we need to tick the world once to let the client update the spawn position
@@ -205,14 +385,12 @@ def main():
         agent = BehaviorAgent(vehicle1, behavior='normal')
 
         # set the destination spot
-        spawn_points = world.get_map().get_spawn_points()
-        random.shuffle(spawn_points)
 
         # to avoid the destination and start position same
-        if spawn_points[0].location != agent._vehicle.get_location():
-            destination = spawn_points[0]
+        if destination_spawn_point.location != agent._vehicle.get_location():
+            destination = destination_spawn_point
         else:
-            destination = spawn_points[1]
+            destination = spawn_points[-2]
 
         print('moved vehicle from %s' % agent._vehicle.get_location())
         print('moved vehicle to %s' % destination.location)
@@ -220,29 +398,69 @@ def main():
         # generate the route
         agent.set_destination( destination.location)
 
-
-        while True:
-            agent._update_information()
-
-            world.tick()
-            data = sensor_queue.get(block=True)
-
-            if len(agent._local_planner._waypoints_queue)<1:
-                print('======== Success, Arrivied at Target Point!')
-                break
-
-            # set the sectator to follow the ego vehicle (top view)
-            spectator = world.get_spectator()
-            transform = vehicle1.get_transform()
-            spectator.set_transform(carla.Transform(transform.location + carla.Location(z=40),
-                                                    carla.Rotation(pitch=-90)))
-            actor_list.append(spectator)
-
-            speed_limit = vehicle1.get_speed_limit()
-            agent.get_local_planner().set_speed(speed_limit)
-
-            control = agent.run_step(debug=True)
-            vehicle1.apply_control(control)
+        # the spectator is a singleton, fetch it once
+        spectator = world.get_spectator()
+        spectator_location = None
+
+        # the speed limit is only asked to the server once a second (20 ticks)
+        tick = 0
+        speed_limit = None
+        speed_limit_tick = 0
+
+        # control computed in the last tick, applied together with the next tick
+        control = None
+
+        # the agent computes the next control in a worker thread while the main
+        # thread waits for the sensor data and moves the spectator
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            while True:
+                agent._update_information()
+
+                if control is None:
+                    world.tick()
+                else:
+                    # apply the control and tick the world in a single call
+                    client.apply_batch_sync([carla.command.ApplyVehicleControl(vehicle1.id, control)], True)
+                # the snapshot of this frame holds the state of every actor
+                snapshot = world.get_snapshot()
+
+                if len(agent._local_planner._waypoints_queue)<1:
+                    print('======== Success, Arrivied at Target Point!')
+                    break
+
+                if speed_limit is None or tick - speed_limit_tick >= 20:
+                    speed_limit = vehicle1.get_speed_limit()
+                    speed_limit_tick = tick
+                agent.get_local_planner().set_speed(speed_limit)
+                tick += 1
+
+                future = executor.submit(agent.run_step, debug=True)
+
+                # drain the sensor data until the frame of this tick shows up, and
+                # only skip the spectator update instead of hanging if the sensor
+                # dropped it. The agent's control is kept, run_step already consumed
+                # its waypoints and updated its state
+                try:
+                    while True:
+                        sensor_frame, sensor_name = sensor_queue.get(timeout=2.0)
+                        if sensor_frame >= snapshot.frame:
+                            break
+                except Empty:
+                    print('sensor timeout, skipping tick')
+                    control = future.result()
+                    continue
+
+                # set the sectator to follow the ego vehicle (top view)
+                # only move it when the ego vehicle moved more than 0.1 m
+                transform = snapshot.find(vehicle1.id).get_transform()
+                location = transform.location
+                if spectator_location is None or \
+                        (location.x - spectator_location.x) ** 2 + (location.y - spectator_location.y) ** 2 >= 0.01:
+                    spectator.set_transform(carla.Transform(location + carla.Location(z=40),
+                                                            carla.Rotation(pitch=-90)))
+                    spectator_location = location
+
+                control = future.result()
 
 
     finally:
@@ -252,9 +470,23 @@ def main():
         settings.fixed_delta_seconds = None
         world.apply_settings(settings)
 
+        # stop the camera first so no callback can evict the sentinel, then let
+        # the writer thread flush the pending images
+        if camera is not None:
+            camera.stop()
+        if writer_thread.is_alive():
+            try:
+                writer_queue.put(None, timeout=10.0)
+                writer_thread.join(timeout=10.0)
+            except Full:
+                print('writer thread is stuck, pending images are lost')
+
         print('destroying actors')
-        client.apply_batch([carla.command.DestroyActor(x) for x in actor_list])
-        client.apply_batch([carla.command.DestroyActor(x) for x in vehicle_list])
+        client.apply_batch_sync([carla.command.DestroyActor(x) for x in actor_list + vehicle_list], True)
+
+        for shm in frame_ring:
+            shm.close()
+            shm.unlink()
         print('done.')
 
 if __name__ == '__main__':